@@ -1,27 +1,28 @@
-import os
 import re
 import io
 import json
 import tempfile
 import hashlib
+import bisect
+import functools
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 from typing import Dict, List, Tuple
 
 import streamlit as st
 import pandas as pd
+import numpy as np
 from pdf2image import convert_from_path
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
+from PIL import ImageDraw
  
 
 
 from utils_pdf import (
     load_table_any,
-    extract_pdf_fields_all,
-    build_field_rect_index,
-    get_page_mediabox,
+    inspect_template,
     fill_pdf_with_pdfrw,
-    make_zip_bytes,
+    fill_pdf_batch,
+    make_zip_file,
 )
 
 st.set_page_config(page_title="PDF Filler (Excel → Fillable PDF)", layout="wide")
@@ -62,20 +63,99 @@ def now_ts() -> str:
 def sha256_bytes(b: bytes) -> str:
     return hashlib.sha256(b).hexdigest()
 
+def cached_upload_hash(state_key: str, uploaded, data: bytes) -> str:
+    # Only re-hash when a different file is uploaded (new file_id), not on every rerun.
+    id_key = f"_{state_key}_file_id"
+    if state_key not in st.session_state or st.session_state.get(id_key) != uploaded.file_id:
+        st.session_state[state_key] = sha256_bytes(data)
+        st.session_state[id_key] = uploaded.file_id
+    return st.session_state[state_key]
+
+_SMART_QUOTES = str.maketrans({"“": '"', "”": '"', "‘": "'", "’": "'"})
+_RULE_TOKEN_RE = re.compile(r"[^,]+")
+
 def _clean_rule_token(v: str) -> str:
     if v is None:
         return ""
-    s = str(v).strip()
-    s = s.replace("“", '"').replace("”", '"').replace("’", "'").replace("‘", "'")
+    s = str(v).translate(_SMART_QUOTES)
     s = s.strip().strip('"').strip("'").strip()
     return s
 
+def _split_rule_values(s: str) -> List[str]:
+    return [t for t in (_clean_rule_token(m.group(0)) for m in _RULE_TOKEN_RE.finditer(s or "")) if t]
+
+# show_fields is kept as a sorted list so the viewer never has to re-sort it.
+def _sorted_contains(items: List[str], x: str) -> bool:
+    i = bisect.bisect_left(items, x)
+    return i < len(items) and items[i] == x
+
+def _sorted_toggle(items: List[str], x: str, on: bool) -> None:
+    i = bisect.bisect_left(items, x)
+    present = i < len(items) and items[i] == x
+    if on and not present:
+        items.insert(i, x)
+    elif not on and present:
+        del items[i]
+
+_UNSAFE_FILENAME_RE = re.compile(r"[^\w\-\. ]+")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+@functools.lru_cache(maxsize=4096)
 def safe_filename(s: str, max_len=70) -> str:
     s = str(s).strip()
-    s = re.sub(r"[^\w\-\. ]+", "_", s)
-    s = re.sub(r"\s+", " ", s).strip()
+    s = _UNSAFE_FILENAME_RE.sub("_", s)
+    s = _WHITESPACE_RE.sub(" ", s).strip()
     return (s[:max_len].rstrip() if s else "row")
 
+# -------------------------
+# Cached PDF rendering
+#
+# Streamlit reruns the whole script on every widget interaction. Keying these
+# on the uploaded PDF bytes means a checkbox tick only re-draws the overlay
+# instead of re-rasterizing the page through Poppler.
+# -------------------------
+@st.cache_data(max_entries=32, show_spinner=False)
+def render_pdf_page(pdf_bytes: bytes, page_i: int, dpi: int):
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as tmp:
+        tmp.write(pdf_bytes)
+        tmp.flush()
+        images = convert_from_path(
+            tmp.name, dpi=dpi, first_page=page_i+1, last_page=page_i+1, thread_count=1
+        )
+    return images[0]
+
+@st.cache_data(show_spinner=False)
+def _parse_pdf(pdf_bytes: bytes):
+    # Parsed straight from the bytes: no temp file, and no process-wide reader cache
+    # (st.cache_data already keys this on the upload's content).
+    info = inspect_template(pdf_bytes)
+    info.check_fillable()
+
+    # Viewer lookups are always "this page, these fields", so index by page first
+    # and keep flat (x0, y0, x1, y1) tuples. Plain dicts: the result gets pickled.
+    rect_index_by_page: Dict[int, Dict[str, List[Tuple[float, float, float, float]]]] = {}
+    for field_name, locs in info.rects.items():
+        for loc in locs:
+            rect_index_by_page.setdefault(loc["page"], {}).setdefault(field_name, []).append(tuple(loc["rect"]))
+
+    # Lowercased once here so the search box doesn't re-lowercase every name per keystroke.
+    pdf_fields_lower = [f.lower() for f in info.order]
+    return info.order, pdf_fields_lower, info.types, rect_index_by_page, info.n_pages, info.mediaboxes
+
+@st.cache_data(show_spinner="Loading data…")
+def _load_table(excel_bytes: bytes, name: str):
+    return load_table_any(excel_bytes, name)
+
+_NAME_COLUMN_TAILS = frozenset({"File_No", "ID", "Name", "PDF_Name", "filename"})
+
+@st.cache_data(show_spinner=False)
+def _column_tails(columns: Tuple[str, ...]) -> Dict[str, Tuple[int, str]]:
+    # "Sheet::Col" -> "Col", remembering the first (position, column) per tail.
+    tails: Dict[str, Tuple[int, str]] = {}
+    for i, c in enumerate(columns):
+        tails.setdefault(c.split("::")[-1], (i, c))
+    return tails
+
 # -------------------------
 # Upload section
 # -------------------------
@@ -90,23 +170,24 @@ if not pdf_file or not data_file:
     st.stop()
 
 # -------------------------
-# Save uploads to temp files
+# Read uploads
 # -------------------------
-tmp_dir = tempfile.mkdtemp(prefix="pdf_filler_")
-pdf_path = os.path.join(tmp_dir, "template.pdf")
+# The template is only ever handled as bytes (cached parsing, preview and ZIP
+# fills all parse it in memory), so nothing is written to disk here.
 data_name = data_file.name
 
 pdf_bytes = pdf_file.getvalue()
 excel_bytes = data_file.getvalue()
 
-with open(pdf_path, "wb") as f:
-    f.write(pdf_bytes)
+# Hash store (used for warnings)
+cached_upload_hash("pdf_hash", pdf_file, pdf_bytes)
+cached_upload_hash("excel_hash", data_file, excel_bytes)
 
 # -------------------------
 # Load table (multi-sheet)
 # -------------------------
 try:
-    df_master, sheets = load_table_any(excel_bytes, data_name)
+    df_master, sheets = _load_table(excel_bytes, data_name)
 except Exception as e:
     st.error(f"Failed to read data file: {e}")
     st.stop()
@@ -121,8 +202,7 @@ if len(sheets) > 1:
 # Extract PDF fields + rects
 # -------------------------
 try:
-    pdf_fields, pdf_field_types = extract_pdf_fields_all(pdf_path)
-    rect_index, page_count = build_field_rect_index(pdf_path)
+    pdf_fields, pdf_fields_lower, pdf_field_types, rect_index_by_page, page_count, page_mediaboxes = _parse_pdf(pdf_bytes)
 except Exception as e:
     st.error(str(e))
     st.stop()
@@ -138,14 +218,10 @@ if "mapping" not in st.session_state:
 if "rules" not in st.session_state:
     st.session_state.rules = {}
 if "show_fields" not in st.session_state:
-    st.session_state.show_fields = set()
+    st.session_state.show_fields = []
 if "show_page" not in st.session_state:
     st.session_state.show_page = 1
 
-# Hash store (used for warnings)
-st.session_state["pdf_hash"] = sha256_bytes(pdf_bytes)
-st.session_state["excel_hash"] = sha256_bytes(excel_bytes)
-
 # ==========================================================
 # Import / Export project.json (backup + QA flow)
 # ==========================================================
@@ -175,14 +251,14 @@ with st.expander("📦 Export / Import Mapping JSON (local backup)"):
 
             # Prevent infinite rerun loops: Streamlit keeps the uploaded file
             # selected across reruns. If we call st.rerun() every time, it will
-            # keep re-importing and re-rerunning.
-            import hashlib
-            import_hash = hashlib.sha1(raw).hexdigest()
-            if st.session_state.get("_last_import_hash") == import_hash:
+            # keep re-importing and re-rerunning. The upload's file_id is stable
+            # across reruns, so it identifies the import without hashing it.
+            import_id = imp.file_id
+            if st.session_state.get("_last_import_id") == import_id:
                 st.info("Project JSON already imported in this session.")
                 obj = None
             else:
-                st.session_state["_last_import_hash"] = import_hash
+                st.session_state["_last_import_id"] = import_id
                 obj = json.loads(raw.decode("utf-8"))
 
             if obj is None:
@@ -231,6 +307,7 @@ if st.sidebar.button("🧹 Reset all checkbox rule widgets"):
     st.rerun()
 
 col_options = [""] + list(df_master.columns)
+col_option_set = frozenset(col_options)  # membership checks below run per visible field
 
 # ==========================================================
 # Main UI: Left fixed-height scroll + Right sticky viewer
@@ -242,7 +319,17 @@ with left:
     search = st.text_input("Search PDF fields", value="")
     page_size = st.selectbox("Fields per page", [15, 25, 50], index=1)
 
-    filtered = [f for f in pdf_fields if search.lower() in f.lower()] if search else pdf_fields
+    # Only re-filter when the search text (or the PDF) actually changed; most reruns
+    # come from other widgets.
+    filter_key = (st.session_state["pdf_hash"], search)
+    if st.session_state.get("_filtered_key") != filter_key:
+        if search:
+            needle = search.lower()
+            st.session_state["_filtered"] = [f for f, fl in zip(pdf_fields, pdf_fields_lower) if needle in fl]
+        else:
+            st.session_state["_filtered"] = pdf_fields
+        st.session_state["_filtered_key"] = filter_key
+    filtered = st.session_state["_filtered"]
     total = len(filtered)
     max_page = max(1, (total + page_size - 1) // page_size)
 
@@ -272,17 +359,17 @@ with left:
                     # If a selectbox key already exists with "" (blank), Streamlit will keep
                     # showing blank even when we set st.session_state.mapping.
                     # Force the widget state to the imported/default value (if valid).
-                    if default_val and default_val in col_options:
-                        if (key not in st.session_state) or (st.session_state.get(key) not in col_options) or (st.session_state.get(key) == ""):
+                    if default_val and default_val in col_option_set:
+                        if (key not in st.session_state) or (st.session_state.get(key) not in col_option_set) or (st.session_state.get(key) == ""):
                             st.session_state[key] = default_val
                     else:
                         # ensure widget state is valid
-                        if key in st.session_state and st.session_state.get(key) not in col_options:
+                        if key in st.session_state and st.session_state.get(key) not in col_option_set:
                             st.session_state[key] = ""
                     chosen = st.selectbox(
                         "Excel Column",
                         col_options,
-                        index=col_options.index(default_val) if default_val in col_options else 0,
+                        index=col_options.index(default_val) if default_val in col_option_set else 0,
                         key=key
                     )
 
@@ -298,12 +385,9 @@ with left:
 
                 with c3:
                     show_key = f"showtoggle::{field_name}"
-                    is_on = field_name in st.session_state.show_fields
+                    is_on = _sorted_contains(st.session_state.show_fields, field_name)
                     toggle = st.checkbox("Show", value=is_on, key=show_key)
-                    if toggle:
-                        st.session_state.show_fields.add(field_name)
-                    else:
-                        st.session_state.show_fields.discard(field_name)
+                    _sorted_toggle(st.session_state.show_fields, field_name, toggle)
 
                 # Checkbox rules UI
                 if ftype == "checkbox_or_radio":
@@ -337,11 +421,8 @@ with left:
                             key=f"def::{field_name}"
                         )
 
-                    checked_vals = [_clean_rule_token(x) for x in (checked_str or "").split(",")]
-                    checked_vals = [x for x in checked_vals if x != ""]
-
-                    unchecked_vals = [_clean_rule_token(x) for x in (unchecked_str or "").split(",")]
-                    unchecked_vals = [x for x in unchecked_vals if x != ""]
+                    checked_vals = _split_rule_values(checked_str)
+                    unchecked_vals = _split_rule_values(unchecked_str)
 
                     st.session_state.rules[field_name] = {
                         "checked_values": checked_vals,
@@ -353,7 +434,7 @@ with right:
     st.markdown('<div class="sticky-viewer">', unsafe_allow_html=True)
     st.subheader("📌 Visual Field Viewer (Sticky + Multi-select)")
 
-    selected = sorted(list(st.session_state.show_fields))
+    selected = st.session_state.show_fields
     if not selected:
         st.info("Tick ON 'Show' for any field(s). Viewer stays visible while you scroll the left list.")
     else:
@@ -375,41 +456,42 @@ with right:
             for k in list(st.session_state.keys()):
                 if str(k).startswith("showtoggle::"):
                     del st.session_state[k]
-            st.session_state.show_fields = set()
+            st.session_state.show_fields = []
             st.rerun()
 
         dpi = 130
-        images = convert_from_path(pdf_path, dpi=dpi, first_page=page_i+1, last_page=page_i+1)
-        img = images[0]
+        img = render_pdf_page(pdf_bytes, page_i, dpi)
 
-        x0, y0, x1, y1 = get_page_mediabox(pdf_path, page_i)
+        x0, y0, x1, y1 = page_mediaboxes[page_i]
         page_w, page_h = (x1 - x0), (y1 - y0)
         img_w, img_h = img.size
         sx, sy = img_w / page_w, img_h / page_h
 
-        fig, ax = plt.subplots(figsize=(6.0, 7.6))
-        ax.imshow(img)
-
-        drawn = 0
-        for field_name in selected:
-            locs = rect_index.get(field_name, [])
-            locs_on_page = [x for x in locs if x.get("page") == page_i]
-            for loc in locs_on_page:
-                rx0, ry0, rx1, ry1 = loc["rect"]
-                ix0 = (rx0 - x0) * sx
-                ix1 = (rx1 - x0) * sx
-                iy0 = img_h - ((ry0 - y0) * sy)
-                iy1 = img_h - ((ry1 - y0) * sy)
-                w = ix1 - ix0
-                h = iy0 - iy1
-                ax.add_patch(
-                    patches.Rectangle((ix0, iy1), w, h, linewidth=3, edgecolor="red", facecolor="none")
-                )
-                drawn += 1
+        # Draw on a copy so the cached page image is never mutated.
+        overlay = img.copy()
+        draw = ImageDraw.Draw(overlay)
+
+        # Project every selected rect from PDF space to image space in one go.
+        rects_on_page = rect_index_by_page.get(page_i, {})
+        rects = np.array(
+            [r for field_name in selected for r in rects_on_page.get(field_name, ())],
+            dtype=np.float64,
+        ).reshape(-1, 4)
+        ix0 = (rects[:, 0] - x0) * sx
+        ix1 = (rects[:, 2] - x0) * sx
+        iy0 = img_h - (rects[:, 1] - y0) * sy
+        iy1 = img_h - (rects[:, 3] - y0) * sy
+
+        # PIL needs top-left then bottom-right; some PDFs store /Rect inverted.
+        boxes = np.stack(
+            [np.minimum(ix0, ix1), np.minimum(iy0, iy1), np.maximum(ix0, ix1), np.maximum(iy0, iy1)],
+            axis=1,
+        )
+        for bx0, by0, bx1, by1 in boxes.tolist():
+            draw.rectangle([(bx0, by0), (bx1, by1)], outline="red", width=3)
+        drawn = len(boxes)
 
-        ax.set_title(f"Page {page_i+1} — highlighted boxes: {drawn}")
-        ax.axis("off")
-        st.pyplot(fig, clear_figure=True)
+        st.image(overlay, caption=f"Page {page_i+1} — highlighted boxes: {drawn}", use_container_width=True)
 
     st.markdown("</div>", unsafe_allow_html=True)
 
@@ -460,19 +542,18 @@ if st.button("👁️ Generate Preview PDF", use_container_width=True):
     else:
         try:
             row = df_master.iloc[preview_row - 1]
-            preview_path = os.path.join(tmp_dir, "preview.pdf")
+            preview_buf = io.BytesIO()
             filled = fill_pdf_with_pdfrw(
-                pdf_path, preview_path, row,
+                pdf_bytes, preview_buf, row,
                 st.session_state.mapping, st.session_state.rules
             )
-            with open(preview_path, "rb") as f:
-                st.download_button(
-                    f"⬇️ Download Preview (filled_fields={filled})",
-                    data=f.read(),
-                    file_name="preview.pdf",
-                    mime="application/pdf",
-                    use_container_width=True
-                )
+            st.download_button(
+                f"⬇️ Download Preview (filled_fields={filled})",
+                data=preview_buf.getvalue(),
+                file_name="preview.pdf",
+                mime="application/pdf",
+                use_container_width=True
+            )
         except Exception as e:
             st.error(f"Preview failed: {e}")
 
@@ -487,24 +568,25 @@ if st.button("Generate ZIP (all rows)", type="primary", use_container_width=True
         st.stop()
 
     ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    out_files = []
     report_rows = []
 
     name_col = None
     if name_hint and name_hint in df_master.columns:
         name_col = name_hint
     else:
-        possible = {"File_No", "ID", "Name", "PDF_Name", "filename"}
-        for c in df_master.columns:
-            if c.split("::")[-1] in possible:
-                name_col = c
-                break
+        # Earliest column whose tail is a known filename column, as before.
+        tails = _column_tails(tuple(df_master.columns))
+        hits = [tails[k] for k in _NAME_COLUMN_TAILS if k in tails]
+        if hits:
+            name_col = min(hits)[1]
 
     used_names = set()
+    batch_rows = []
 
-    for i in range(len(df_master)):
-        row_no = i + 1
-        row = df_master.iloc[i]
+    # itertuples avoids building a pandas Series per row; workers only need a dict.
+    cols = list(df_master.columns)
+    for row_no, row_tuple in enumerate(df_master.itertuples(index=False, name=None), start=1):
+        row = dict(zip(cols, row_tuple))
 
         if name_col and str(row.get(name_col, "")).strip():
             base = safe_filename(row.get(name_col))
@@ -519,31 +601,48 @@ if st.button("Generate ZIP (all rows)", type="primary", use_container_width=True
             fname = f"{base}_{k}.pdf"
         used_names.add(fname)
 
-        out_path = os.path.join(tmp_dir, fname)
+        batch_rows.append((fname, row))
+
+    batch_failures = []
 
+    def _zip_entries():
+        # Rows are independent, so fill them across processes; results keep row order.
+        # Each PDF is handed to the ZIP writer as it arrives instead of piling up
+        # in a list first; the report goes last, once every row is known.
+        results = fill_pdf_batch(pdf_bytes, batch_rows, st.session_state.mapping, st.session_state.rules)
         try:
-            filled = fill_pdf_with_pdfrw(
-                pdf_path, out_path, row,
-                st.session_state.mapping, st.session_state.rules
-            )
-            status = "OK" if filled > 0 else "ZERO_FILLED"
-            report_rows.append({"row": row_no, "file": fname, "status": status, "filled_fields": filled, "error": ""})
-            with open(out_path, "rb") as f:
-                out_files.append((fname, f.read()))
+            for row_no, (fname, out_bytes, filled, error) in enumerate(results, start=1):
+                if error:
+                    report_rows.append({"row": row_no, "file": fname, "status": "ERROR", "filled_fields": 0, "error": error})
+                    continue
+                status = "OK" if filled > 0 else "ZERO_FILLED"
+                report_rows.append({"row": row_no, "file": fname, "status": status, "filled_fields": filled, "error": ""})
+                yield fname, out_bytes
+        except BrokenProcessPool as e:
+            batch_failures.append(f"PDF worker pool failed (a worker could not start or was killed, e.g. out of memory): {e}")
         except Exception as e:
-            report_rows.append({"row": row_no, "file": fname, "status": "ERROR", "filled_fields": 0, "error": str(e)})
+            batch_failures.append(str(e))
+
+        # Pool-level failure: every row without a result is reported as ERROR.
+        if batch_failures:
+            for row_no, (fname, _row) in enumerate(batch_rows[len(report_rows):], start=len(report_rows) + 1):
+                report_rows.append({"row": row_no, "file": fname, "status": "ERROR", "filled_fields": 0, "error": batch_failures[0]})
 
-    report_df = pd.DataFrame(report_rows)
-    report_csv = report_df.to_csv(index=False).encode("utf-8")
+        report_df = pd.DataFrame(report_rows)
+        yield "_REPORT.csv", report_df.to_csv(index=False).encode("utf-8")
+        yield "mapping_rules.json", mapping_json
 
-    out_files.append(("_REPORT.csv", report_csv))
-    out_files.append(("mapping_rules.json", mapping_json))
+    # The archive itself is built in memory (nothing touches disk); every entry
+    # yielded above is bytes, i.e. content rather than a path.
+    buf = io.BytesIO()
+    make_zip_file(_zip_entries(), buf)
 
-    zip_bytes = make_zip_bytes(out_files)
+    if batch_failures:
+        st.error(f"PDF generation stopped early: {batch_failures[0]} (see _REPORT.csv in the ZIP).")
 
     st.download_button(
         f"⬇️ Download ZIP (generated at {ts})",
-        data=zip_bytes,
+        data=buf,
         file_name=f"filled_pdfs_{ts}.zip",
         mime="application/zip",
         use_container_width=True
@@ -1,12 +1,23 @@
 import os
 import io
+import math
+import multiprocessing
+import functools
 import zipfile
-import re
-from typing import Dict, List, Tuple, Any, Optional
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Tuple, Any, Optional, Union, BinaryIO, Iterable, Iterator, Sequence
 
 import pandas as pd
 from pdfrw import PdfReader, PdfWriter, PdfDict, PdfName, PdfString, PdfObject
 
+# PdfName.X is built by pdfrw's __getattr__ on every access; resolve the ones
+# used inside per-field loops once.
+_FT_BTN = PdfName.Btn
+_SUB_WIDGET = PdfName.Widget
+_AP_OFF = PdfName.Off
+_AP_YES = PdfName.Yes
+
 
 # -------------------------
 # Text auto-fit helpers
@@ -16,9 +27,42 @@ from pdfrw import PdfReader, PdfWriter, PdfDict, PdfName, PdfString, PdfObject
 # appearance (/DA) has a fixed font size. Setting the font size to 0 in /DA is the
 # standard way to enable AutoSize in many PDF viewers.
 # -------------------------
+def _is_pdf_number(tok: str) -> bool:
+    body = tok[1:] if tok.startswith("-") else tok
+    int_part, dot, frac = body.partition(".")
+    return int_part.isdecimal() and (not dot or frac.isdecimal())
+
+
+def _zero_da_font_size(da_txt: str) -> str:
+    """
+    Replace the first "<whitespace><number> Tf" with "0 Tf" using plain str
+    scanning (no regex engine on this per-field path). Numbers are "-?d+(.d+)?"
+    and "Tf" must end the token. Returns da_txt unchanged when nothing matches.
+    """
+    i = da_txt.find("Tf")
+    while i != -1:
+        end = i + 2
+        if end == len(da_txt) or not (da_txt[end].isalnum() or da_txt[end] == "_"):
+            j = i
+            while j > 0 and da_txt[j - 1].isspace():
+                j -= 1
+            k = j
+            while k > 0 and (da_txt[k - 1].isdecimal() or da_txt[k - 1] == "."):
+                k -= 1
+            if k > 0 and da_txt[k - 1] == "-":
+                k -= 1
+            if j < i and k > 0 and da_txt[k - 1].isspace() and _is_pdf_number(da_txt[k:j]):
+                return da_txt[:k] + "0 Tf" + da_txt[end:]
+        i = da_txt.find("Tf", i + 1)
+    return da_txt
+
+
 def _pdfstr_to_text(v: Any) -> str:
     if v is None:
         return ""
+    # Already-decoded text: PDF literal/hex strings always start with "(" or "<".
+    if isinstance(v, str) and not v.startswith(("(", "<")):
+        return v
     try:
         # pdfrw PdfString objects support decode
         return PdfString.decode(v)
@@ -32,10 +76,14 @@ def _set_da_autosize(field: Any) -> None:
     if not da:
         return
     da_txt = _pdfstr_to_text(da)
+    # Already auto-size: skip the scan and re-encode. Only trusted with a single
+    # Tf, since the scan below rewrites the first one.
+    if " 0 Tf" in da_txt and da_txt.count("Tf") == 1:
+        return
 
     # Replace the first "<number> Tf" with "0 Tf" (keeps the font resource).
     # Example: "/Helv 10 Tf 0 g" -> "/Helv 0 Tf 0 g"
-    new_da = re.sub(r"(\s)(-?\d+(?:\.\d+)?)\s+Tf\b", r"\g<1>0 Tf", da_txt, count=1)
+    new_da = _zero_da_font_size(da_txt)
     if new_da != da_txt:
         try:
             field.DA = PdfString.encode(new_da)
@@ -47,28 +95,48 @@ def _set_da_autosize(field: Any) -> None:
 # -------------------------
 # Excel/CSV loader (multi-sheet)
 # -------------------------
+# Arrow-backed strings: one contiguous buffer per column instead of one
+# Python object per cell (pyarrow ships with streamlit).
+_STR_DTYPE = "string[pyarrow]"
+
+
+def _read_excel_sheets(file_bytes: bytes, ext: str) -> Dict[str, pd.DataFrame]:
+    # python-calamine (Rust) reads workbooks several times faster than openpyxl
+    # and yields the same strings. It is a declared dependency; the fallback only
+    # covers environments where its wheel could not be installed.
+    try:
+        return pd.read_excel(io.BytesIO(file_bytes), sheet_name=None, dtype=_STR_DTYPE, engine="calamine")
+    except ImportError:
+        pass
+
+    if ext in [".xlsx", ".xlsm"]:
+        # Stream rows instead of building the full worksheet DOM, and read cached
+        # formula results rather than formulas.
+        return pd.read_excel(
+            io.BytesIO(file_bytes), sheet_name=None, dtype=_STR_DTYPE,
+            engine="openpyxl", engine_kwargs={"read_only": True, "data_only": True},
+        )
+    return pd.read_excel(io.BytesIO(file_bytes), sheet_name=None, dtype=_STR_DTYPE)
+
+
 def load_table_any(file_bytes: bytes, filename: str) -> Tuple[pd.DataFrame, Dict[str, pd.DataFrame]]:
     ext = os.path.splitext(filename)[1].lower()
 
     if ext == ".csv":
-        df = pd.read_csv(io.BytesIO(file_bytes), dtype=str).fillna("")
+        df = pd.read_csv(io.BytesIO(file_bytes), dtype=_STR_DTYPE).fillna("")
         return df, {"__csv__": df}
 
     if ext in [".xlsx", ".xls", ".xlsm"]:
-        sheets = pd.read_excel(io.BytesIO(file_bytes), sheet_name=None, dtype=str)
-        for k in list(sheets.keys()):
-            sheets[k] = sheets[k].fillna("")
+        sheets = _read_excel_sheets(file_bytes, ext)
 
-        master = None
+        # One outer-aligned concat instead of joining sheet by sheet
+        # (each join re-materialized the whole growing master frame).
+        renamed = []
         for sheet_name, sdf in sheets.items():
-            sdf2 = sdf.copy()
-            sdf2.columns = [f"{sheet_name}::{c}" for c in sdf2.columns]
-            if master is None:
-                master = sdf2
-            else:
-                master = master.join(sdf2, how="outer")
+            sheets[sheet_name] = sdf.fillna("")
+            renamed.append(sheets[sheet_name].set_axis([f"{sheet_name}::{c}" for c in sdf.columns], axis=1))
 
-        master = master.fillna("")
+        master = pd.concat(renamed, axis=1).fillna("")
         return master, sheets
 
     raise ValueError("Unsupported file. Please upload .xlsx/.xlsm or .csv")
@@ -77,6 +145,19 @@ def load_table_any(file_bytes: bytes, filename: str) -> Tuple[pd.DataFrame, Dict
 # -------------------------
 # PDF helpers
 # -------------------------
+@functools.lru_cache(maxsize=8)
+def _read_pdf_cached(pdf_path: str, mtime_ns: int, size: int) -> PdfReader:
+    # Path-based introspection shares one parse per file version (path + mtime + size).
+    # Never mutate the result; filling always works on its own PdfReader.
+    # Uploads never come through here: the app inspects their bytes directly.
+    return PdfReader(pdf_path)
+
+
+def _read_pdf(pdf_path: str) -> PdfReader:
+    stat = os.stat(pdf_path)
+    return _read_pdf_cached(pdf_path, stat.st_mtime_ns, stat.st_size)
+
+
 def is_xfa_pdf(template) -> bool:
     try:
         acro = template.Root.AcroForm
@@ -87,32 +168,47 @@ def is_xfa_pdf(template) -> bool:
     return False
 
 
-def iter_fields(field_list):
+def iter_fields(field_list) -> List[Any]:
     """
-    Yield BOTH parent fields and kids.
+    Return BOTH parent fields and kids, in depth-first order.
     Many PDFs store the field name (/T) on the parent,
     and the visible widgets in /Kids.
     """
-    if not field_list:
-        return
-    for f in field_list:
-        yield f
+    # Explicit stack (kids pushed reversed to keep document order):
+    # no generator frame per nesting level, no recursion limit.
+    # `seen` stops malformed /Kids that point back at an ancestor from looping forever.
+    out = []
+    seen = set()
+    stack = list(reversed(field_list)) if field_list else []
+    while stack:
+        f = stack.pop()
+        if id(f) in seen:
+            continue
+        seen.add(id(f))
+        out.append(f)
         kids = getattr(f, "Kids", None)
         if kids:
-            for k in iter_fields(kids):
-                yield k
+            stack.extend(reversed(kids))
+    return out
 
 
-def clean_field_name(tval) -> Optional[str]:
-    if tval is None:
-        return None
-    name = str(tval).strip()
+@functools.lru_cache(maxsize=4096)
+def _clean_field_name_cached(raw: str) -> Optional[str]:
+    name = raw.strip()
     if name.startswith("(") and name.endswith(")"):
         name = name[1:-1]
     name = name.strip()
     return name if name else None
 
 
+def clean_field_name(tval) -> Optional[str]:
+    if tval is None:
+        return None
+    # Key on the plain str, not the pdfrw object, so the cache never keeps
+    # a parsed template alive.
+    return _clean_field_name_cached(str(tval))
+
+
 def rect_to_list(r) -> Optional[List[float]]:
     try:
         return [float(r[0]), float(r[1]), float(r[2]), float(r[3])]
@@ -136,7 +232,7 @@ def get_checkbox_on_value(field) -> PdfName:
         n = getattr(ap, "N", None) if ap else None
         if n:
             for k in n.keys():
-                if str(k) != "/Off":
+                if k != _AP_OFF:
                     return k  # ✅ return key as-is
     except Exception:
         pass
@@ -150,67 +246,135 @@ def get_checkbox_on_value(field) -> PdfName:
                 n = getattr(ap, "N", None) if ap else None
                 if n:
                     for k in n.keys():
-                        if str(k) != "/Off":
+                        if k != _AP_OFF:
                             return k  # ✅ return key as-is
     except Exception:
         pass
 
     # Fallback
-    return PdfName.Yes
+    return _AP_YES
+
+
+_DEFAULT_CHECKBOX_RULE = {
+    "checked_values": ["yes", "true", "1", "x", "on", "checked", "male"],
+    "unchecked_values": ["no", "false", "0", "off", "unchecked", "", "female"],
+    "default": "off"
+}
+
+
+def _compile_rule(rule: dict) -> dict:
+    """Normalise a checkbox rule once into frozensets for O(1) lookups."""
+    return {
+        "checked": frozenset(str(x).strip().lower() for x in rule.get("checked_values", [])),
+        "unchecked": frozenset(str(x).strip().lower() for x in rule.get("unchecked_values", [])),
+        "default_on": str(rule.get("default", "off")).strip().lower() == "on",
+    }
+
+
+def _compile_rules(rules: Dict[str, dict]) -> Dict[str, dict]:
+    return {nm: _compile_rule(rule) for nm, rule in (rules or {}).items()}
+
+
+_DEFAULT_CHECKBOX_RULE_COMPILED = _compile_rule(_DEFAULT_CHECKBOX_RULE)
 
 
 def should_check(value: str, rule: dict) -> bool:
+    """rule is a compiled rule (see _compile_rule); raw UI rules are compiled on the fly."""
+    if "default_on" not in rule:
+        rule = _compile_rule(rule)
     v = str(value).strip().lower()
-    checked_values = [str(x).strip().lower() for x in rule.get("checked_values", [])]
-    unchecked_values = [str(x).strip().lower() for x in rule.get("unchecked_values", [])]
-    default = str(rule.get("default", "off")).strip().lower()
 
-    if v in checked_values:
+    if v in rule["checked"]:
         return True
-    if v in unchecked_values:
+    if v in rule["unchecked"]:
         return False
-    return True if default == "on" else False
+    return rule["default_on"]
 
 
 # -------------------------
 # Field extraction (AcroForm + Page Widgets)
+#
+# inspect_template walks the AcroForm and the page annotations once and
+# collects everything the UI needs. The older per-purpose helpers below are
+# thin wrappers over it.
 # -------------------------
-def extract_pdf_fields_all(pdf_path: str) -> Tuple[List[str], Dict[str, str]]:
-    pdf = PdfReader(pdf_path)
+_DEFAULT_MEDIABOX = (0.0, 0.0, 612.0, 792.0)
 
-    if getattr(pdf.Root, "AcroForm", None) is None:
-        raise RuntimeError("PDF has no AcroForm fields (not standard fillable).")
-    if is_xfa_pdf(pdf):
-        raise RuntimeError("This PDF is XFA. Convert to AcroForm first.")
+
+@dataclass
+class TemplateInfo:
+    order: List[str]                          # field names, first-seen order
+    types: Dict[str, str]                     # name -> "text" | "checkbox_or_radio"
+    rects: Dict[str, List[Dict[str, Any]]]    # name -> [{"page": i, "rect": [x0, y0, x1, y1]}]
+    n_pages: int
+    mediaboxes: List[Tuple[float, float, float, float]]
+    has_acroform: bool
+    is_xfa: bool
+
+    def check_fillable(self) -> None:
+        if not self.has_acroform:
+            raise RuntimeError("PDF has no AcroForm fields (not standard fillable).")
+        if self.is_xfa:
+            raise RuntimeError("This PDF is XFA. Convert to AcroForm first.")
+
+
+def _page_mediabox(page) -> Tuple[float, float, float, float]:
+    media = getattr(page, "MediaBox", None)
+    if not media:
+        return _DEFAULT_MEDIABOX
+    try:
+        return (float(media[0]), float(media[1]), float(media[2]), float(media[3]))
+    except Exception:
+        return _DEFAULT_MEDIABOX
+
+
+def inspect_template(template_source: Union[str, bytes, PdfReader]) -> TemplateInfo:
+    """
+    template_source is a path (parse shared via the path+mtime cache), the PDF
+    bytes themselves (parsed in memory, nothing cached) or a PdfReader.
+    """
+    if isinstance(template_source, PdfReader):
+        pdf = template_source
+    elif isinstance(template_source, bytes):
+        pdf = PdfReader(fdata=template_source)
+    else:
+        pdf = _read_pdf(template_source)
+    acro = getattr(pdf.Root, "AcroForm", None)
 
     fields: List[Tuple[str, str]] = []
+    rects: Dict[str, List[Dict[str, Any]]] = {}
+    mediaboxes: List[Tuple[float, float, float, float]] = []
 
-    all_fields = getattr(pdf.Root.AcroForm, "Fields", None)
+    all_fields = getattr(acro, "Fields", None) if acro is not None else None
     if all_fields:
         for f in iter_fields(all_fields):
             nm = clean_field_name(getattr(f, "T", None))
             if not nm:
                 continue
             ft = getattr(f, "FT", None)
-            ftype = "checkbox_or_radio" if ft == PdfName.Btn else "text"
+            ftype = "checkbox_or_radio" if ft == _FT_BTN else "text"
             fields.append((nm, ftype))
 
-    for p in getattr(pdf, "pages", []):
-        annots = getattr(p, "Annots", None)
+    pages = getattr(pdf, "pages", [])
+    for pi, page in enumerate(pages):
+        mediaboxes.append(_page_mediabox(page))
+        annots = getattr(page, "Annots", None)
         if not annots:
             continue
+        # No per-annotation try: pdfrw's getattr yields None for missing keys
+        # and broken references, and rect_to_list handles malformed /Rect.
         for a in annots:
-            try:
-                if getattr(a, "Subtype", None) != PdfName.Widget:
-                    continue
-                nm = clean_field_name(getattr(a, "T", None))
-                if not nm:
-                    continue
-                ft = getattr(a, "FT", None)
-                ftype = "checkbox_or_radio" if ft == PdfName.Btn else "text"
-                fields.append((nm, ftype))
-            except Exception:
+            if getattr(a, "Subtype", None) != _SUB_WIDGET:
+                continue
+            nm = clean_field_name(getattr(a, "T", None))
+            if not nm:
                 continue
+            ft = getattr(a, "FT", None)
+            ftype = "checkbox_or_radio" if ft == _FT_BTN else "text"
+            fields.append((nm, ftype))
+            r = rect_to_list(getattr(a, "Rect", None))
+            if r:
+                rects.setdefault(nm, []).append({"page": pi, "rect": r})
 
     merged: Dict[str, str] = {}
     order: List[str] = []
@@ -222,59 +386,116 @@ def extract_pdf_fields_all(pdf_path: str) -> Tuple[List[str], Dict[str, str]]:
             if merged[nm] != "checkbox_or_radio" and tp == "checkbox_or_radio":
                 merged[nm] = tp
 
-    return order, merged
+    return TemplateInfo(
+        order=order,
+        types=merged,
+        rects=rects,
+        n_pages=len(pages),
+        mediaboxes=mediaboxes,
+        has_acroform=acro is not None,
+        is_xfa=is_xfa_pdf(pdf),
+    )
 
 
-def build_field_rect_index(pdf_path: str) -> Tuple[Dict[str, List[Dict[str, Any]]], int]:
-    pdf = PdfReader(pdf_path)
-    idx: Dict[str, List[Dict[str, Any]]] = {}
+def extract_pdf_fields_all(pdf_path: str) -> Tuple[List[str], Dict[str, str]]:
+    info = inspect_template(pdf_path)
+    info.check_fillable()
+    return info.order, info.types
 
-    pages = getattr(pdf, "pages", [])
-    for pi, page in enumerate(pages):
-        annots = getattr(page, "Annots", None)
-        if not annots:
-            continue
-        for a in annots:
-            try:
-                if getattr(a, "Subtype", None) != PdfName.Widget:
-                    continue
-                nm = clean_field_name(getattr(a, "T", None))
-                if not nm:
-                    continue
-                r = rect_to_list(getattr(a, "Rect", None))
-                if not r:
-                    continue
-                idx.setdefault(nm, []).append({"page": pi, "rect": r})
-            except Exception:
-                continue
 
-    return idx, len(pages)
+def build_field_rect_index(pdf_path: str) -> Tuple[Dict[str, List[Dict[str, Any]]], int]:
+    info = inspect_template(pdf_path)
+    return info.rects, info.n_pages
 
 
 def get_page_mediabox(pdf_path: str, page_index: int) -> Tuple[float, float, float, float]:
-    pdf = PdfReader(pdf_path)
-    page = pdf.pages[page_index]
-    media = getattr(page, "MediaBox", None)
-    if not media:
-        return (0.0, 0.0, 612.0, 792.0)
-    x0, y0, x1, y1 = float(media[0]), float(media[1]), float(media[2]), float(media[3])
-    return (x0, y0, x1, y1)
+    # One page's box: read it off the cached reader instead of a full inspect_template walk.
+    return _page_mediabox(_read_pdf(pdf_path).pages[page_index])
 
 
 # -------------------------
 # Fill PDF
+#
+# Filling only writes a handful of keys on the field dicts, so a template that
+# was parsed once can be reused for many rows: snapshot those keys before the
+# fill and put them back afterwards. Much cheaper than re-parsing per row.
+# (copy.deepcopy does not work on pdfrw objects.)
 # -------------------------
+_FILL_KEYS = (PdfName.V, PdfName.AS, PdfName.DA, PdfName.AP, PdfName.Ff)
+
+
+def _snapshot_fill_state(template: PdfReader) -> List[Tuple[PdfDict, Dict[Any, Any]]]:
+    acro = getattr(template.Root, "AcroForm", None)
+    if acro is None:
+        return []
+    # dict.get: keep the raw stored value (may be an unresolved indirect ref).
+    saved = [(acro, {PdfName.NeedAppearances: dict.get(acro, PdfName.NeedAppearances)})]
+    for f in iter_fields(getattr(acro, "Fields", None)):
+        saved.append((f, {k: dict.get(f, k) for k in _FILL_KEYS}))
+    return saved
+
+
+def _restore_fill_state(saved: List[Tuple[PdfDict, Dict[Any, Any]]]) -> None:
+    for obj, values in saved:
+        for k, v in values.items():
+            obj[k] = v  # None removes a key the fill added
+
+
 def fill_pdf_with_pdfrw(
-    template_path: str,
-    output_path: str,
-    data_row: pd.Series,
+    template_source: Union[str, bytes, BinaryIO, PdfReader],
+    output_path: Union[str, BinaryIO],
+    data_row: Union[pd.Series, Dict[str, Any]],
     mapping: Dict[str, str],
     rules: Dict[str, dict],
     debug: bool = False,
     force_autosize_text: bool = True,
 ) -> int:
-    template = PdfReader(template_path)
-
+    """
+    Fill one row into the template and write the result to output_path.
+    template_source is a path, file object, the PDF bytes themselves (parsed
+    in memory, no file read), or an already-parsed PdfReader. A PdfReader is
+    left unchanged afterwards so the caller can reuse it for the next row.
+    """
+    if isinstance(template_source, PdfReader):
+        saved = _snapshot_fill_state(template_source)
+        try:
+            return _fill_template(template_source, output_path, data_row, mapping, rules, debug, force_autosize_text)
+        finally:
+            _restore_fill_state(saved)
+
+    if isinstance(template_source, bytes):
+        template = PdfReader(fdata=template_source)
+    else:
+        template = PdfReader(template_source)
+    return _fill_template(template, output_path, data_row, mapping, rules, debug, force_autosize_text)
+
+
+def _index_fields(all_fields) -> Dict[str, List[Any]]:
+    """Map each field name to every field object (parents and kids) carrying it."""
+    idx: Dict[str, List[Any]] = {}
+    for f in iter_fields(all_fields):
+        nm = clean_field_name(getattr(f, "T", None))
+        if nm:
+            idx.setdefault(nm, []).append(f)
+    return idx
+
+
+def _fill_template(
+    template: PdfReader,
+    output_path: Union[str, BinaryIO],
+    data_row: Union[pd.Series, Dict[str, Any]],
+    mapping: Dict[str, str],
+    rules: Dict[str, dict],
+    debug: bool,
+    force_autosize_text: bool,
+    fields_by_name: Optional[Dict[str, List[Any]]] = None,
+    encode_cache: Optional[Dict[str, PdfString]] = None,
+) -> int:
+    """
+    fields_by_name: _index_fields() of this template, when the caller reuses it for many rows.
+    encode_cache: value -> PdfString shared across the rows of one batch. Never
+    module-level, so cell values don't outlive the batch that filled them.
+    """
     if getattr(template.Root, "AcroForm", None) is None:
         raise RuntimeError("No AcroForm found in PDF.")
     if is_xfa_pdf(template):
@@ -290,82 +511,202 @@ def fill_pdf_with_pdfrw(
     if not all_fields:
         raise RuntimeError("AcroForm exists, but no fields found in AcroForm.Fields")
 
-    for field in iter_fields(all_fields):
-        nm = clean_field_name(getattr(field, "T", None))
-        if not nm or nm not in mapping:
-            continue
-
-        excel_col = mapping[nm]
-        if not excel_col or excel_col not in data_row.index:
+    # Only visit fields that are actually mapped instead of every field in the form.
+    if fields_by_name is None:
+        fields_by_name = _index_fields(all_fields)
+    if encode_cache is None:
+        encode_cache = {}
+    compiled_rules = _compile_rules(rules)
+    # Plain dict lookups per mapped column instead of pandas label lookups.
+    row = data_row.to_dict() if isinstance(data_row, pd.Series) else data_row
+    for nm, excel_col in mapping.items():
+        if not excel_col or excel_col not in row:
             continue
 
-        value = str(data_row.get(excel_col, ""))
-        ft = getattr(field, "FT", None)
+        # load_table_any already yields str cells; only coerce anything else.
+        value = row.get(excel_col, "")
+        if not isinstance(value, str):
+            value = str(value)
+        for field in fields_by_name.get(nm, ()):
+            ft = getattr(field, "FT", None)
 
-        # Checkbox / Radio
-        if ft == PdfName.Btn:
-            rule = rules.get(nm, {
-                "checked_values": ["yes", "true", "1", "x", "on", "checked", "male"],
-                "unchecked_values": ["no", "false", "0", "off", "unchecked", "", "female"],
-                "default": "off"
-            })
+            # Checkbox / Radio
+            if ft == _FT_BTN:
+                rule = compiled_rules.get(nm, _DEFAULT_CHECKBOX_RULE_COMPILED)
 
-            on_val = get_checkbox_on_value(field)
-            do_check = should_check(value, rule)
+                on_val = get_checkbox_on_value(field)
+                do_check = should_check(value, rule)
 
-            if debug:
-                print(f"[DEBUG] '{nm}' value={repr(value)} do_check={do_check} on_val={on_val}")
+                if debug:
+                    print(f"[DEBUG] '{nm}' value={repr(value)} do_check={do_check} on_val={on_val}")
 
-            # parent /V is logical value
-            field.V = on_val if do_check else PdfName.Off
+                # parent /V is logical value
+                field.V = on_val if do_check else _AP_OFF
 
-            # kids /AS controls visible checkmark
-            kids = getattr(field, "Kids", None)
-            if kids:
-                for kid in kids:
-                    kid.AS = on_val if do_check else PdfName.Off
-            else:
-                field.AS = on_val if do_check else PdfName.Off
+                # kids /AS controls visible checkmark
+                kids = getattr(field, "Kids", None)
+                if kids:
+                    for kid in kids:
+                        kid.AS = on_val if do_check else _AP_OFF
+                else:
+                    field.AS = on_val if do_check else _AP_OFF
 
-            filled_count += 1
-            continue
+                filled_count += 1
+                continue
 
-        # Text
-        # Optional: force AutoSize by switching font size in /DA to 0 Tf.
-        # This keeps V1 behaviour (viewer regenerates appearances) but also fixes
-        # templates that would otherwise clip/occlude long values.
-        if force_autosize_text:
-            try:
+            # Text
+            # Optional: force AutoSize by switching font size in /DA to 0 Tf.
+            # This keeps V1 behaviour (viewer regenerates appearances) but also fixes
+            # templates that would otherwise clip/occlude long values.
+            # (_set_da_autosize guards its own encode; assigning None to a
+            # PdfDict key just removes it, so none of this needs a try.)
+            if force_autosize_text:
                 _set_da_autosize(field)
-            except Exception:
-                pass
 
-        field.V = PdfString.encode(value)
-        try:
-            if getattr(field, "AP", None) is not None:
-                field.AP = None
-        except Exception:
-            pass
+            # PdfString is an immutable str subclass, so one encoded instance can be
+            # shared by every field (and row) holding the same value ("", "N/A", ...).
+            encoded = encode_cache.get(value)
+            if encoded is None:
+                encoded = encode_cache[value] = PdfString.encode(value)
+            field.V = encoded
+            field.AP = None
 
-        filled_count += 1
+            filled_count += 1
 
-        # ensure not read-only
-        try:
-            if hasattr(field, "Ff"):
-                field.Ff = None
-        except Exception:
-            pass
+            # ensure not read-only
+            field.Ff = None
 
+    # pdfrw writes to a path or to any object with .write() (e.g. io.BytesIO).
     PdfWriter().write(output_path, template)
     return filled_count
 
 
+# -------------------------
+# Batch fill (process pool)
+#
+# Lives here rather than in app.py so worker processes can import it.
+# The pool initializer hands each worker the template bytes, mapping and
+# rules once; tasks then carry only (filename, row dict). Everything stays
+# in memory: the template is parsed once per worker process and each
+# filled PDF is written to a BytesIO.
+#
+# Workers come from a forkserver, never a fork of the (multi-threaded)
+# Streamlit server, and there are only as many as there are chunks of rows;
+# a batch that fits in one chunk is filled in-process with no pool at all.
+# -------------------------
+_BATCH_CHUNKSIZE = 8
+# forkserver is POSIX-only; spawn is the other start method that doesn't fork.
+_POOL_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+_BATCH: Dict[str, Any] = {}
+
+
+def _batch_state(template_bytes: bytes, mapping: Dict[str, str], rules: Dict[str, dict], force_autosize_text: bool) -> Dict[str, Any]:
+    template = PdfReader(fdata=template_bytes)
+    acro = getattr(template.Root, "AcroForm", None)
+    return {
+        "template": template,
+        # Every row is restored to this same pristine state, so the field index and
+        # the snapshot are built once per batch rather than walking the tree per row.
+        "fields_by_name": _index_fields(getattr(acro, "Fields", None)),
+        "pristine": _snapshot_fill_state(template),
+        "mapping": mapping,
+        "rules": rules,
+        "force_autosize_text": force_autosize_text,
+        "encode_cache": {},
+    }
+
+
+def _batch_init(template_bytes: bytes, mapping: Dict[str, str], rules: Dict[str, dict], force_autosize_text: bool) -> None:
+    _BATCH.update(_batch_state(template_bytes, mapping, rules, force_autosize_text))
+
+
+def _fill_with_state(state: Dict[str, Any], item: Tuple[str, Dict[str, Any]]) -> Tuple[str, bytes, int, str]:
+    fname, row_dict = item
+    try:
+        out = io.BytesIO()
+        try:
+            filled = _fill_template(
+                state["template"], out, row_dict, state["mapping"], state["rules"],
+                False, state["force_autosize_text"], state["fields_by_name"], state["encode_cache"],
+            )
+        finally:
+            _restore_fill_state(state["pristine"])
+        return fname, out.getvalue(), filled, ""
+    except Exception as e:
+        return fname, b"", 0, str(e)
+
+
+def _batch_fill_one(item: Tuple[str, Dict[str, Any]]) -> Tuple[str, bytes, int, str]:
+    return _fill_with_state(_BATCH, item)
+
+
+def _available_cpus() -> int:
+    # Honour CPU affinity / container cpusets where the platform exposes them.
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def fill_pdf_batch(
+    template_bytes: bytes,
+    rows: Sequence[Tuple[str, Dict[str, Any]]],
+    mapping: Dict[str, str],
+    rules: Dict[str, dict],
+    force_autosize_text: bool = True,
+    max_workers: Optional[int] = None,
+) -> Iterator[Tuple[str, bytes, int, str]]:
+    """
+    Fill (filename, row dict) pairs, across processes when there is more than
+    one chunk of rows. Yields (filename, pdf_bytes, filled_count, error) in
+    input order, as results arrive; a failed row yields b"" and the error message.
+    """
+    n_chunks = math.ceil(len(rows) / _BATCH_CHUNKSIZE)
+    workers = min(max_workers or _available_cpus(), n_chunks)
+
+    if workers <= 1:
+        state = _batch_state(template_bytes, mapping, rules, force_autosize_text)
+        for item in rows:
+            yield _fill_with_state(state, item)
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context(_POOL_START_METHOD),
+        initializer=_batch_init,
+        initargs=(template_bytes, mapping, rules, force_autosize_text),
+    ) as ex:
+        yield from ex.map(_batch_fill_one, rows, chunksize=_BATCH_CHUNKSIZE)
+
+
 # -------------------------
 # ZIP packaging
 # -------------------------
-def make_zip_bytes(files: List[Tuple[str, bytes]]) -> bytes:
+# pdfrw writes object dictionaries uncompressed, so filled PDFs still shrink
+# several-fold; level 1 gets most of that at a fraction of level 6's CPU.
+ZIP_COMPRESSION = {"compression": zipfile.ZIP_DEFLATED, "compresslevel": 1}
+
+
+def make_zip_file(
+    files: Iterable[Tuple[str, Union[str, os.PathLike, bytes]]],
+    out_path: Union[str, os.PathLike, BinaryIO],
+) -> None:
+    """
+    Write (arcname, source) pairs into a ZIP at out_path (path or file object).
+    A str/PathLike source is a file on disk and is streamed in by zipfile in
+    chunks; a bytes source is stored as-is. files may be a generator, so only
+    one entry needs to be in memory at a time.
+    """
+    with zipfile.ZipFile(out_path, "w", **ZIP_COMPRESSION) as z:
+        for name, src in files:
+            if isinstance(src, (str, os.PathLike)):
+                z.write(src, arcname=name)
+            else:
+                z.writestr(name, src)
+
+
+def make_zip_bytes(files: List[Tuple[str, Union[str, bytes]]]) -> bytes:
+    # In-memory entries: str is content here (UTF-8, as writestr stores it),
+    # so encode it before make_zip_file would take it for a path.
     buf = io.BytesIO()
-    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED) as z:
-        for name, data in files:
-            z.writestr(name, data)
+    make_zip_file(((name, data.encode("utf-8") if isinstance(data, str) else data) for name, data in files), buf)
     return buf.getvalue()